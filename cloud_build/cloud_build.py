@@ -1,14 +1,25 @@
 #!/usr/bin/python3
 
-from typing import Dict, List, Set, Tuple, Union, Optional
+from typing import (
+    Callable, Dict, Iterable, Iterator, List, NoReturn, Set, Tuple, Union,
+    Optional,
+)
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from pathlib import Path
 
-import contextlib
+import collections
+import copy
 import datetime
+import errno
 import fcntl
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import os
 import re
+import shlex
 import shutil
 import string
 import subprocess
@@ -19,12 +30,202 @@ import yaml
 import cloud_build.image_tests
 import cloud_build.rename
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore
+
 PROG = 'cloud-build'
 
+_TARGET_TYPE_RE = re.compile(r'(?:(\w+)/)?.*')
+_ENABLED_RE = re.compile(r'enabled?')
+_DISABLED_RE = re.compile(r'disabled?')
+_SIZE_RE = re.compile(
+    r'^(?P<num> \d+(:?.\d+)? ) (?P<suff> [kmg] )?$',
+    re.IGNORECASE | re.VERBOSE,
+)
+_SIZE_MULTIPLIERS = {
+    '': 1,
+    'k': 2 ** 10,
+    'm': 2 ** 20,
+    'g': 2 ** 30,
+}
+_FICLONE = 0x40049409  # linux ioctl to reflink a file
+_FORMATTER = string.Formatter()
+# threads for local file operations: hashing, copying, removing
+_FILE_WORKERS = 8
+
+APT_CONF_TEMPLATE = '''
+Dir::Etc::main "/dev/null";
+Dir::Etc::parts "/var/empty";
+Dir::Etc::SourceList "{sources_list}";
+Dir::Etc::SourceParts "/var/empty";
+Dir::Etc::preferences "/dev/null";
+Dir::Etc::preferencesparts "/var/empty";
+'''.lstrip()
+
 # types
 PathLike = Union[Path, str]
 
 
+@functools.lru_cache(maxsize=1)
+def get_data_dir() -> Path:
+    """Default directory for data of cloud-build"""
+    data_home = os.getenv('XDG_DATA_HOME', '~/.local/share')
+    return Path(os.path.expanduser(os.path.expandvars(data_home))) / PROG
+
+
+def _write_json_cache(cache_file: Path, data: Dict) -> None:
+    try:
+        dumped = json.dumps(data)
+    except (TypeError, ValueError):
+        return
+    # yaml allows values json can not represent, e.g. non string keys
+    if json.loads(dumped) != data:
+        return
+
+    tmp = cache_file.with_name(f'{cache_file.name}.{os.getpid()}')
+    try:
+        with open(tmp, 'w') as f:
+            f.write(dumped)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=16)
+def _load_yaml(
+    path: str,
+    sig: Tuple[int, int, int],
+    cache_file: Optional[Path],
+) -> Dict:
+    """Parse yaml file or take it from the cache_file if it is fresh"""
+    key = [os.path.abspath(path), *sig]
+    if cache_file is not None:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                return cached['config']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    with open(path) as f:
+        cfg = yaml.load(f, Loader=YamlLoader)
+    if cache_file is not None:
+        _write_json_cache(cache_file, {'key': key, 'config': cfg})
+    return cfg
+
+
+def _read_yaml_cached(path: str, cache_file: Optional[Path] = None) -> Dict:
+    """Read yaml file reusing result of previous parse if file unchanged
+
+    Parsed config is also kept in the cache_file to be reused by
+    subsequent runs.
+    """
+    st = os.stat(path)
+    sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return copy.deepcopy(_load_yaml(path, sig, cache_file))
+
+
+def _sha256_line(name: str, directory: PathLike = '') -> str:
+    h = hashlib.sha256()
+    buf = memoryview(bytearray(1 << 20))
+    with open(os.path.join(directory, name), 'rb', buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(buf[:n])
+    digest = h.hexdigest()
+    # escape names the same way as coreutils do
+    if '\\' in name or '\n' in name:
+        name = name.replace('\\', '\\\\').replace('\n', '\\n')
+        return f'\\{digest}  {name}\n'
+    return f'{digest}  {name}\n'
+
+
+def sha256sum(files: List[str], directory: PathLike = '') -> str:
+    """Return checksums of files in the format of sha256sum utility
+
+    Files are opened relative to directory, but listed by given names.
+    """
+    if not files:
+        return ''
+    max_workers = min(_FILE_WORKERS, len(files))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return ''.join(executor.map(
+            _sha256_line,
+            files,
+            itertools.repeat(directory),
+        ))
+
+
+def _fast_copy(src: Path, dst: Path) -> None:
+    """Hardlink src to dst falling back to reflink and to in-kernel copy"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        # other filesystem or hardlinks are not supported
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+
+            left = os.fstat(fsrc.fileno()).st_size
+            while left > 0:
+                copied = os.copy_file_range(
+                    fsrc.fileno(),
+                    fdst.fileno(),
+                    left,
+                )
+                if not copied:
+                    break
+                left -= copied
+            if left <= 0:
+                return
+    except OSError:
+        pass
+
+    shutil.copyfile(src, dst)
+
+
+def _bounded_map(
+    executor: Executor,
+    func: Callable,
+    args_list: Iterable[Tuple],
+    limit: int,
+) -> Iterator:
+    """Like executor.map, but keeps at most limit calls in flight"""
+    args_iter = iter(args_list)
+    pending: collections.deque[Future] = collections.deque(
+        executor.submit(func, *args)
+        for args in itertools.islice(args_iter, limit)
+    )
+    while pending:
+        result = pending.popleft().result()
+        for args in itertools.islice(args_iter, 1):
+            pending.append(executor.submit(func, *args))
+        yield result
+
+
+def _normalize_constraints(data: Dict) -> Dict[str, Dict]:
+    """Turn lists in constraints of packages or services into sets"""
+    result = {}
+    for item, constraints in data.items():
+        if constraints is None:
+            constraints = {}
+        result[item] = {
+            key: frozenset(value) if isinstance(value, list) else value
+            for key, value in constraints.items()
+        }
+    return result
+
+
 class Error(Exception):
     pass
 
@@ -59,9 +260,17 @@ class CB:
             tasks: Optional[dict[str, List[str]]] = None,
             built_images_dir: Optional[PathLike] = None,
             config_override: Optional[Dict] = None,
+            lock_timeout: float = 0,
     ) -> None:
-        self.initialized = False
-        self._save_cwd = os.getcwd()
+        self.closed = False
+        self.lock_timeout = lock_timeout
+        self.service_default_state = 'enabled'
+        if not data_dir:
+            data_dir = get_data_dir()
+        else:
+            data_dir = Path(data_dir).absolute()
+        self.data_dir = data_dir
+
         self.parse_config(config, config_override)
         if config_override \
             and (
@@ -76,28 +285,23 @@ class CB:
         else:
             self.tasks = tasks
 
-        if not data_dir:
-            data_dir = (Path(self.expand_path(os.getenv('XDG_DATA_HOME',
-                                                        '~/.local/share')))
-                        / f'{PROG}')
-        else:
-            data_dir = Path(data_dir).absolute()
-        self.data_dir = data_dir
-
-        self.checksum_command = 'sha256sum'
-
         if built_images_dir:
             self._images_dir = Path(built_images_dir).absolute()
             self.no_build = True
         else:
             self._images_dir = data_dir / 'images'
             self.no_build = False
+        self._images_dirs: Dict[Tuple[str, str], Path] = {}
+        self._repository_urls: Dict[Tuple[str, str], str] = {}
+        self._image_repos: Dict[Tuple[str, str], Optional[str]] = {}
+        self._images_dirs_remotes: Optional[List[Tuple[Path, str]]] = None
         self.work_dir = data_dir / 'work'
         self.out_dir = data_dir / 'out'
+        self.apt_dir = self.work_dir / 'apt'
 
-        self.service_default_state = 'enabled'
         self.created_scripts: List[Path] = []
         self._build_errors: List[BuildError] = []
+        self._out_mtimes: Dict[str, float] = {}
 
         self.ensure_dirs()
         logging.basicConfig(
@@ -108,43 +312,36 @@ class CB:
         self.log.setLevel(self.log_level)
         self.ensure_run_once()
         self.info(f'Start {PROG}')
-        self.initialized = True
 
-    def __del__(self) -> None:
-        if not self.initialized:
-            if getattr(self, 'lock_file', False):
-                self.lock_file.close()
+    def __enter__(self) -> 'CB':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Cleans mkimage-profiles working tree and releases the lock"""
+        if self.closed:
             return
+        self.closed = True
 
+        mp_dir = self.work_dir / 'mkimage-profiles'
         # check directory exists for test: work dir deleted to early
-        if (self.work_dir / 'mkimage-profiles' / '.git').exists():
-            os.chdir(self.work_dir / 'mkimage-profiles')
-            subprocess.run(['git', 'reset', '--hard'])
-            subprocess.run(['git', 'clean', '-fdx'])
-        os.chdir(self._save_cwd)
+        if (mp_dir / '.git').exists():
+            self.call(['git', 'reset', '--hard'],
+                      fail_on_error=False, cwd=mp_dir)
+            self.call(['git', 'clean', '-fdx'],
+                      fail_on_error=False, cwd=mp_dir)
         try:
             self.info(f'Finish {PROG}')
         except FileNotFoundError:
             pass
         self.lock_file.close()
 
-    @property
-    def _remote_formaters(self) -> Set[str]:
-        return {
-            key
-            for tup in string.Formatter().parse(self._remote)
-            if (key := tup[1]) is not None
-        }
-
-    @property
-    def is_remote_arch(self) -> bool:
-        return 'arch' in self._remote_formaters
-
-    @property
-    def is_remote_branch(self) -> bool:
-        return 'branch' in self._remote_formaters
-
     def images_dirs_remotes_list(self) -> List[Tuple[Path, str]]:
+        if self._images_dirs_remotes is not None:
+            return self._images_dirs_remotes
+
         images_dirs_list = []
         images_dir = self._images_dir
         if self.is_remote_branch:
@@ -165,17 +362,20 @@ class CB:
             else:
                 images_dirs_list.append((images_dir, self._remote))
 
+        self._images_dirs_remotes = images_dirs_list
         return images_dirs_list
 
     def images_dirs_list(self) -> List[Path]:
         return [pair[0] for pair in self.images_dirs_remotes_list()]
 
     def images_dir(self, branch: str, arch: str) -> Path:
-        images_dir = self._images_dir
-        if self.is_remote_branch:
-            images_dir = images_dir / branch
-        if self.is_remote_arch:
-            images_dir = images_dir / arch
+        if (images_dir := self._images_dirs.get((branch, arch))) is None:
+            images_dir = self._images_dir
+            if self.is_remote_branch:
+                images_dir = images_dir / branch
+            if self.is_remote_arch:
+                images_dir = images_dir / arch
+            self._images_dirs[(branch, arch)] = images_dir
         return images_dir
 
     def expand_path(self, path: PathLike):
@@ -186,23 +386,34 @@ class CB:
             return result
 
     def ensure_run_once(self) -> None:
-        self.lock_file = open(self.data_dir / f'{PROG}.lock', 'w')
-
-        try:
-            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except OSError:  # already locked
-            dd = self.data_dir
-            msg = f'Program {PROG} already running in `{dd}` directory'
-            self.error(msg)
+        self.lock_file = open(self.data_dir / f'{PROG}.lock', 'a+')
+
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.05
+        while True:
+            try:
+                fcntl.flock(
+                    self.lock_file.fileno(),
+                    fcntl.LOCK_EX | fcntl.LOCK_NB,
+                )
+                break
+            except OSError:  # already locked
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self.lock_file.seek(0)
+                    pid = self.lock_file.read().strip()
+                    self.lock_file.close()
+                    dd = self.data_dir
+                    msg = f'Program {PROG} already running in `{dd}` directory'
+                    if pid:
+                        msg += f' with pid {pid}'
+                    self.error(msg)
+                time.sleep(min(delay, timeout))
+                delay = min(delay * 2, 1)
 
-    @contextlib.contextmanager
-    def pushd(self, new_dir):
-        previous_dir = os.getcwd()
-        self.debug(f'Pushd to {new_dir}')
-        os.chdir(new_dir)
-        yield
-        self.debug(f'Popd from {new_dir}')
-        os.chdir(previous_dir)
+        self.lock_file.truncate(0)
+        self.lock_file.write(f'{os.getpid()}\n')
+        self.lock_file.flush()
 
     def parse_config(
         self,
@@ -213,8 +424,10 @@ class CB:
             override = {}
 
         try:
-            with open(config) as f:
-                cfg = yaml.safe_load(f)
+            cfg = _read_yaml_cached(
+                config,
+                self.data_dir / 'config.cache.json',
+            )
         except OSError as e:
             msg = f'Could not read config file `{e.filename}`: {e.strerror}'
             raise Error(msg)
@@ -228,10 +441,20 @@ class CB:
             else:
                 return cfg[key]
 
+        def positive_int(key, value):
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, int)
+                or value < 1
+            ):
+                raise Error(f'Parameter `{key}` should be a positive integer')
+            return value
+
         self.mkimage_profiles_git = self.expand_path(
             get_overrided('mkimage_profiles_git', '')
         )
         self.mkimage_profiles_branch = get_overrided('mkimage_profiles_branch')
+        self.git_cache_ttl = cfg.get('git_cache_ttl', 3600)
 
         self.log_level = getattr(logging, cfg.get('log_level', 'INFO').upper())
 
@@ -248,6 +471,9 @@ class CB:
 
         self.try_build_all = cfg.get('try_build_all', False)
 
+        self.jobs = positive_int('jobs', get_overrided('jobs', 1))
+        self.sync_jobs = positive_int('sync_jobs', cfg.get('sync_jobs', 8))
+
         self.no_delete = cfg.get('no_delete', True)
 
         self.bad_arches = cfg.get('bad_arches', [])
@@ -270,8 +496,8 @@ class CB:
             else:
                 raise
 
-        self._packages = cfg.get('packages', {})
-        self._services = cfg.get('services', {})
+        self._packages = _normalize_constraints(cfg.get('packages', {}))
+        self._services = _normalize_constraints(cfg.get('services', {}))
         self._scripts = cfg.get('scripts', {})
 
         self._after_sync_commands = cfg.get('after_sync_commands', [])
@@ -291,13 +517,36 @@ class CB:
             msg = f'Required parameter {e} does not set in config'
             raise Error(msg)
 
+        images = {}
+        for image, image_cfg in self._images.items():
+            # copy to leave the caller's override untouched
+            images[image] = image_cfg = dict(image_cfg)
+            for exclude in ('exclude_arches', 'exclude_branches'):
+                if exclude in image_cfg:
+                    value = image_cfg[exclude]
+                    if isinstance(value, str):
+                        value = [value]
+                    image_cfg[exclude] = frozenset(value)
+        self._images = images
+
+        self._remote_formaters = frozenset(
+            key
+            for tup in _FORMATTER.parse(self._remote)
+            if (key := tup[1]) is not None
+        )
+        self.is_remote_arch = 'arch' in self._remote_formaters
+        self.is_remote_branch = 'branch' in self._remote_formaters
+
+        self._branch_lower = {b: b.lower() for b in self._branches}
+        self.index_items()
+
     def info(self, msg: str) -> None:
         self.log.info(msg)
 
     def debug(self, msg: str) -> None:
         self.log.debug(msg)
 
-    def error(self, arg: Union[str, Error]) -> None:
+    def error(self, arg: Union[str, Error]) -> NoReturn:
         if isinstance(arg, Error):
             err = arg
         else:
@@ -305,17 +554,20 @@ class CB:
         self.log.error(err)
         raise err
 
-    def remote(self, branch: str, arch: str) -> str:
-        return self._remote.format(branch=branch, arch=arch)
-
     def repository_url(self, branch: str, arch: str) -> str:
-        url = self._branches[branch]['arches'][arch].get('repository_url')
-        if url is None:
-            url = self._branches[branch].get('repository_url',
-                                             self._repository_url)
-        return url.format(branch=branch, arch=arch)
+        if (url := self._repository_urls.get((branch, arch))) is None:
+            url = self._branches[branch]['arches'][arch].get('repository_url')
+            if url is None:
+                url = self._branches[branch].get('repository_url',
+                                                 self._repository_url)
+            url = url.format(branch=branch, arch=arch)
+            self._repository_urls[(branch, arch)] = url
+        return url
+
+    def image_repo(self, branch: str, arch: str) -> Optional[str]:
+        if (branch, arch) in self._image_repos:
+            return self._image_repos[(branch, arch)]
 
-    def image_repo(self, branch: str, arch: str) -> str:
         url = self._branches[branch]['arches'][arch].get('image_repo')
         if url is None:
             url = self._branches[branch].get('image_repo',
@@ -324,91 +576,102 @@ class CB:
         if url is not None:
             url = url.format(branch=branch, arch=arch)
 
+        self._image_repos[(branch, arch)] = url
         return url
 
     def call(
         self,
         cmd: List[str],
         *,
-        stdout_to_file: str = '',
+        stdout_to_file: PathLike = '',
         fail_on_error: bool = True,
+        cwd: Optional[PathLike] = None,
     ) -> None:
-        def maybe_fail(string: str, rc: int) -> None:
+        def maybe_fail(rc: int) -> None:
             if fail_on_error:
                 if rc != 0:
                     msg = 'Command `{}` failed with {} return code'.format(
-                        string,
+                        ' '.join(cmd),
                         rc,
                     )
                     self.error(msg)
 
         # just_print = True
         just_print = False
-        string = ' '.join(cmd)
-        self.debug(f'Call `{string}`')
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.debug('Call `{}`'.format(' '.join(cmd)))
         if just_print:
-            print(string)
+            print(' '.join(cmd))
         else:
             if stdout_to_file:
-                # TODO rewrite using subprocess.run
-                p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                rc = p.wait()
-                maybe_fail(string, rc)
-                # TODO rewrite by passing f as stdout value
-                with open(stdout_to_file, 'w') as f:
-                    if p.stdout:
-                        f.write(p.stdout.read().decode())
-                    if p.stdout is not None:
-                        p.stdout.close()
+                with open(stdout_to_file, 'wb') as f:
+                    rc = subprocess.call(cmd, stdout=f, cwd=cwd)
+                maybe_fail(rc)
             else:
                 # TODO rewrite using subprocess.run
-                rc = subprocess.call(cmd)
-                maybe_fail(string, rc)
+                rc = subprocess.call(cmd, cwd=cwd)
+                maybe_fail(rc)
 
     def ensure_dirs(self) -> None:
-        for attr in dir(self):
-            if attr.endswith('_dir'):
-                value = getattr(self, attr)
-                if isinstance(value, str) or isinstance(value, os.PathLike):
-                    os.makedirs(value, exist_ok=True)
-
-        for images_dir in self.images_dirs_list():
-            os.makedirs(images_dir, exist_ok=True)
+        directories = dict.fromkeys([
+            self.data_dir,
+            self._images_dir,
+            self.work_dir,
+            self.out_dir,
+            *self.images_dirs_list(),
+        ])
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
 
     def generate_apt_files(self) -> None:
-        apt_dir = self.work_dir / 'apt'
+        apt_dir = self.apt_dir
         os.makedirs(apt_dir, exist_ok=True)
         for branch in self.branches:
             for arch in self.arches_by_branch(branch):
                 repo = self.repository_url(branch, arch)
+                sources_list_path = f'{apt_dir}/sources.list.{branch}.{arch}'
+                apt_conf = APT_CONF_TEMPLATE.format(
+                    sources_list=sources_list_path,
+                )
                 with open(f'{apt_dir}/apt.conf.{branch}.{arch}', 'w') as f:
-                    apt_conf = f'''
-Dir::Etc::main "/dev/null";
-Dir::Etc::parts "/var/empty";
-Dir::Etc::SourceList "{apt_dir}/sources.list.{branch}.{arch}";
-Dir::Etc::SourceParts "/var/empty";
-Dir::Etc::preferences "/dev/null";
-Dir::Etc::preferencesparts "/var/empty";
-'''.lstrip()
                     f.write(apt_conf)
 
-                with open(f'{apt_dir}/sources.list.{branch}.{arch}', 'w') as f:
-                    sources_list = f'rpm {repo} {arch} classic\n'
-                    if arch == 'x86_64':
-                        sources_list += f'rpm {repo} {arch}-i586 classic\n'
-                    if arch not in self.bad_arches:
-                        sources_list += f'rpm {repo} noarch classic\n'
-                    for task in self.tasks.get(branch.lower(), []):
-                        tr = 'http://git.altlinux.org'
-                        sources_list += f'rpm {tr} repo/{task}/{arch} task\n'
-                    f.write(sources_list)
+                sources_list = [f'rpm {repo} {arch} classic\n']
+                if arch == 'x86_64':
+                    sources_list.append(f'rpm {repo} {arch}-i586 classic\n')
+                if arch not in self.bad_arches:
+                    sources_list.append(f'rpm {repo} noarch classic\n')
+                tr = 'http://git.altlinux.org'
+                sources_list.extend(
+                    f'rpm {tr} repo/{task}/{arch} task\n'
+                    for task in self.tasks.get(self._branch_lower[branch], [])
+                )
+                with open(sources_list_path, 'w') as f:
+                    f.write(''.join(sources_list))
 
     def escape_branch(self, branch: str) -> str:
-        return re.sub(r'\.', '_', branch)
+        return branch.replace('.', '_')
 
-    def patch_mp(self):
+    def patch_mp(self, mp_dir: Path) -> None:
         if (patch_mp_prog := self.patch_mp_prog) is not None:
-            self.call([patch_mp_prog])
+            self.call([patch_mp_prog], cwd=mp_dir)
+
+    def ensure_git_mirror(self, url: str) -> Path:
+        """Creates or updates bare mirror of url in data_dir"""
+        name = hashlib.sha256(url.encode()).hexdigest()[:16]
+        cache_dir = self.data_dir / 'git-cache'
+        mirror = cache_dir / f'{name}.git'
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_dir / f'{name}.lock', 'w') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            if not os.path.isdir(mirror):
+                self.info(f'Mirroring {url}')
+                self.call(['git', 'clone', '--mirror', url, str(mirror)])
+            elif time.time() - os.path.getmtime(mirror) > self.git_cache_ttl:
+                self.info(f'Updating mirror of {url}')
+                self.call(['git', 'remote', 'update', '--prune'], cwd=mirror)
+                os.utime(mirror)
+        return mirror
 
     def ensure_mkimage_profiles(self, force_recreate=False) -> None:
         """Checks that mkimage-profiles exists or clones it"""
@@ -423,63 +686,79 @@ Dir::Etc::preferencesparts "/var/empty";
                 + 'git.altlinux.org/'
                 + 'people/antohami/packages/mkimage-profiles.git'
             )
-        os.chdir(self.work_dir)
-        if force_recreate and os.path.isdir('mkimage-profiles'):
-            shutil.rmtree('mkimage-profiles')
-        if os.path.isdir('mkimage-profiles'):
-            with self.pushd('mkimage-profiles'):
-                self.info('Updating mkimage-profiles')
-                self.call(['git', 'pull', '--ff-only'], fail_on_error=True)
+        mirror = self.ensure_git_mirror(url)
+        mp_dir = self.work_dir / 'mkimage-profiles'
+        if force_recreate and os.path.isdir(mp_dir):
+            shutil.rmtree(mp_dir)
+        fetch_head = mp_dir / '.git' / 'FETCH_HEAD'
+        if (
+            os.path.exists(fetch_head)
+            and os.path.getmtime(fetch_head) >= os.path.getmtime(mirror)
+        ):
+            # mirror was not updated since the last fetch
+            self.info('Skip updating mkimage-profiles')
+        elif os.path.isdir(mp_dir):
+            self.info('Updating mkimage-profiles')
+            # stay on the checked out branch, but take it from the mirror
+            self.call(['git', 'remote', 'set-url', 'origin', str(mirror)],
+                      cwd=mp_dir)
+            self.call(['git', 'pull', '--ff-only'], cwd=mp_dir)
         else:
             self.info('Downloading mkimage-profiles')
-            git_clone = ['git', 'clone', url, 'mkimage-profiles']
+            git_clone = ['git', 'clone', '--single-branch']
             if branch := self.mkimage_profiles_branch:
                 git_clone.extend(['--branch', branch])
+            git_clone.extend([str(mirror), str(mp_dir)])
             self.call(git_clone)
 
+        self.patch_mp(mp_dir)
+
         # create file with proper brandings
-        with self.pushd('mkimage-profiles'):
-            self.patch_mp()
-            with open(f'conf.d/{PROG}.mk', 'w') as f:
-                for image in self.images:
-                    target = self.target_by_image(image)
-                    for branch in self.branches:
-                        ebranch = self.escape_branch(branch)
-
-                        prerequisites = [target]
-                        prerequisites.extend(
-                            self.prerequisites_by_branch(branch)
-                        )
-                        prerequisites.extend(
-                            self.prerequisites_by_image(image)
-                        )
-                        prerequisites_s = ' '.join(prerequisites)
-
-                        recipes = []
-
-                        for package in self.packages(image, branch):
-                            recipes.append(
-                                add_recipe(
-                                    'BASE_PACKAGES',
-                                    package))
-
-                        for service in self.enabled_services(image, branch):
-                            recipes.append(
-                                add_recipe(
-                                    'DEFAULT_SERVICES_ENABLE',
-                                    service))
-                        for service in self.disabled_services(image, branch):
-                            recipes.append(
-                                add_recipe(
-                                    'DEFAULT_SERVICES_DISABLE',
-                                    service))
-
-                        recipes_s = ''.join(recipes)
-
-                        rule = f'''
+        image_info = {
+            image: (
+                self.target_by_image(image),
+                self.prerequisites_by_image(image),
+            )
+            for image in self.images
+        }
+        branch_info = {
+            branch: (
+                self.escape_branch(branch),
+                self.prerequisites_by_branch(branch),
+            )
+            for branch in self.branches
+        }
+
+        rules = []
+        for image, branch in itertools.product(self.images, self.branches):
+            target, image_prerequisites = image_info[image]
+            ebranch, branch_prerequisites = branch_info[branch]
+
+            prerequisites_s = ' '.join(
+                (target, *branch_prerequisites, *image_prerequisites)
+            )
+
+            recipes = [
+                add_recipe('BASE_PACKAGES', package)
+                for package in self.packages(image, branch)
+            ]
+            recipes.extend(
+                add_recipe('DEFAULT_SERVICES_ENABLE', service)
+                for service in self.enabled_services(image, branch)
+            )
+            recipes.extend(
+                add_recipe('DEFAULT_SERVICES_DISABLE', service)
+                for service in self.disabled_services(image, branch)
+            )
+            recipes_s = ''.join(recipes)
+
+            rule = f'''
 {target}_{ebranch}: {prerequisites_s}; @:{recipes_s}
 '''.strip()
-                        print(rule, file=f)
+            rules.append(f'{rule}\n')
+
+        with open(mp_dir / 'conf.d' / f'{PROG}.mk', 'w') as f:
+            f.write(''.join(rules))
 
         self.generate_apt_files()
 
@@ -508,18 +787,11 @@ Dir::Etc::preferencesparts "/var/empty";
         return self._images[image]['kinds']
 
     def convert_size(self, size: str) -> Optional[str]:
+        if size.isascii() and size.isdigit():
+            return size
+
         result = None
-        multiplier = {
-            '': 1,
-            'k': 2 ** 10,
-            'm': 2 ** 20,
-            'g': 2 ** 30,
-        }
-        match = re.match(
-            r'^(?P<num> \d+(:?.\d+)? ) (?P<suff> [kmg] )?$',
-            size,
-            re.IGNORECASE | re.VERBOSE,
-        )
+        match = _SIZE_RE.match(size)
         if not match:
             self.error('Bad size format')
         else:
@@ -527,13 +799,15 @@ Dir::Etc::preferencesparts "/var/empty";
             suff = match.group('suff')
             if suff is None:
                 suff = ''
-            mul = multiplier[str.lower(suff)]
+            mul = _SIZE_MULTIPLIERS[str.lower(suff)]
             result = str(round(num * mul))
 
         return result
 
     def size_by_image(self, image: str) -> Optional[str]:
         size = self._images[image].get('size')
+        if type(size) is int and size >= 0:
+            return str(size)
         if size is not None:
             size = self.convert_size(str(size))
         return size
@@ -564,48 +838,35 @@ Dir::Etc::preferencesparts "/var/empty";
         return scripts
 
     def skip_arch(self, image: str, arch: str) -> bool:
-        return arch in self._images[image].get('exclude_arches', [])
+        return arch in self._images[image].get('exclude_arches', ())
 
     def skip_branch(self, image: str, branch: str) -> bool:
-        return branch in self._images[image].get('exclude_branches', [])
+        return branch in self._images[image].get('exclude_branches', ())
 
     def get_items(
         self,
         data: Dict,
         image: str,
         branch: str,
-        state_re: str = None,
-        default_state: str = None,
     ) -> List[str]:
         items = []
 
-        if state_re is None:
-            state_re = ''
-        if default_state is None:
-            default_state = state_re
-
         for item, constraints in data.items():
-            if constraints is None:
-                constraints = {}
-
             if (
-                image in constraints.get('exclude_images', [])
-                or branch in constraints.get('exclude_branches', [])
+                image in constraints.get('exclude_images', ())
+                or branch in constraints.get('exclude_branches', ())
             ):
                 continue
 
-            # Empty means no constraint: e.g. all images
-            images = constraints.get('images', [image])
-            branches = constraints.get('branch', [branch])
-
-            state = constraints.get('state', default_state)
+            # Absent means no constraint: e.g. all images
+            images = constraints.get('images')
+            branches = constraints.get('branch')
+            if images is not None and image not in images:
+                continue
+            if branches is not None and branch not in branches:
+                continue
 
-            if (
-                image in images
-                and branch in branches
-                and re.match(state_re, state)
-            ):
-                items.append(item)
+            items.append(item)
 
         return items
 
@@ -618,29 +879,40 @@ Dir::Etc::preferencesparts "/var/empty";
 
         return self._branches[branch].get('branding')
 
+    def index_items(self) -> None:
+        """Resolves packages and services for every image and branch"""
+        self._packages_index = {}
+        self._services_index = {}
+        for image, branch in itertools.product(self._images, self._branches):
+            key = (image, branch)
+            self._packages_index[key] = self.get_items(
+                self._packages,
+                image,
+                branch,
+            )
+            enabled, disabled = [], []
+            for service in self.get_items(self._services, image, branch):
+                state = self._services[service].get(
+                    'state',
+                    self.service_default_state,
+                )
+                if _ENABLED_RE.match(state):
+                    enabled.append(service)
+                elif _DISABLED_RE.match(state):
+                    disabled.append(service)
+            self._services_index[key] = (enabled, disabled)
+
     def packages(self, image: str, branch: str) -> List[str]:
         image_packages = self._images[image].get('packages', [])
-        return image_packages + self.get_items(self._packages, image, branch)
+        return image_packages + self._packages_index[(image, branch)]
 
     def enabled_services(self, image: str, branch: str) -> List[str]:
         image_services = self._images[image].get('services_enabled', [])
-        return image_services + self.get_items(
-            self._services,
-            image,
-            branch,
-            'enabled?',
-            self.service_default_state,
-        )
+        return image_services + self._services_index[(image, branch)][0]
 
     def disabled_services(self, image: str, branch: str) -> List[str]:
         image_services = self._images[image].get('services_disabled', [])
-        return image_services + self.get_items(
-            self._services,
-            image,
-            branch,
-            'disabled?',
-            self.service_default_state,
-        )
+        return image_services + self._services_index[(image, branch)][1]
 
     def build_failed(self, target, arch):
         if self.try_build_all:
@@ -648,11 +920,12 @@ Dir::Etc::preferencesparts "/var/empty";
         else:
             self.error(BuildError(target, arch))
 
-    def should_rebuild(self, tarball):
-        if not os.path.exists(tarball):
+    def should_rebuild(self, tarball: Path) -> bool:
+        mtime = self._out_mtimes.get(tarball.name)
+        if mtime is None:
             rebuild = True
         else:
-            lived = time.time() - os.path.getmtime(tarball)
+            lived = time.time() - mtime
             delta = datetime.timedelta(seconds=lived)
             rebuild = delta > self.rebuild_after
             if rebuild:
@@ -669,40 +942,43 @@ Dir::Etc::preferencesparts "/var/empty";
         size: str = None,
     ) -> Optional[Path]:
         target = f'{target}_{self.escape_branch(branch)}'
-        image = re.sub(r'.*/', '', target)
+        image = target.rpartition('/')[2]
         full_target = f'{target}.{kind}'
         tarball_name = f'{image}-{arch}.{kind}'
         tarball_path = self.out_dir / tarball_name
         result: Optional[Path] = tarball_path
-        apt_dir = self.work_dir / 'apt'
-        with self.pushd(self.work_dir / 'mkimage-profiles'):
-            if not self.should_rebuild(tarball_path):
-                self.info(f'Skip building of {full_target} {arch}')
+        apt_dir = self.apt_dir
+        if not self.should_rebuild(tarball_path):
+            self.info(f'Skip building of {full_target} {arch}')
+        else:
+            image_repo = self.image_repo(branch, arch)
+            cmd = [
+                'make',
+                f'APTCONF={apt_dir}/apt.conf.{branch}.{arch}',
+                f'ARCH={arch}',
+                f'BRANCH={self._branch_lower[branch]}',
+                f'IMAGE_OUTDIR={self.out_dir}',
+                f'IMAGE_OUTFILE={tarball_name}',
+            ]
+            if branding is not None:
+                cmd.append(f'BRANDING={branding}')
+            if image_repo is not None:
+                cmd.append(f'REPO={image_repo}')
+            if size is not None:
+                cmd.append(f'VM_SIZE={size}')
+            cmd.append(full_target)
+            self.info(f'Begin building of {full_target} {arch}')
+            self.call(
+                cmd,
+                fail_on_error=False,
+                cwd=self.work_dir / 'mkimage-profiles',
+            )
+
+            if os.path.exists(tarball_path):
+                self.info(f'End building of {full_target} {arch}')
             else:
-                image_repo = self.image_repo(branch, arch)
-                cmd = [
-                    'make',
-                    f'APTCONF={apt_dir}/apt.conf.{branch}.{arch}',
-                    f'ARCH={arch}',
-                    f'BRANCH={branch.lower()}',
-                    f'IMAGE_OUTDIR={self.out_dir}',
-                    f'IMAGE_OUTFILE={tarball_name}',
-                ]
-                if branding is not None:
-                    cmd.append(f'BRANDING={branding}')
-                if image_repo is not None:
-                    cmd.append(f'REPO={image_repo}')
-                if size is not None:
-                    cmd.append(f'VM_SIZE={size}')
-                cmd.append(full_target)
-                self.info(f'Begin building of {full_target} {arch}')
-                self.call(cmd, fail_on_error=False)
-
-                if os.path.exists(tarball_path):
-                    self.info(f'End building of {full_target} {arch}')
-                else:
-                    result = None
-                    self.build_failed(full_target, arch)
+                result = None
+                self.build_failed(full_target, arch)
 
         return result
 
@@ -713,7 +989,7 @@ Dir::Etc::preferencesparts "/var/empty";
         arch: str,
         kind: str
     ) -> Path:
-        name = f'alt-{branch.lower()}-{image}-{arch}.{kind}'
+        name = f'alt-{self._branch_lower[branch]}-{image}-{arch}.{kind}'
         rename_dict = self._images[image].get('rename', {})
         if rename_dict:
             name = cloud_build.rename.rename(rename_dict, name)
@@ -721,25 +997,38 @@ Dir::Etc::preferencesparts "/var/empty";
         return path
 
     def copy_image(self, src: Path, dst: Path, *, rewrite=False) -> None:
-        if rewrite and dst.exists():
-            os.unlink(dst)
-        os.link(src, dst)
+        if rewrite:
+            try:
+                # already linked on previous run
+                if os.path.samefile(src, dst):
+                    return
+                os.unlink(dst)
+            except FileNotFoundError:
+                pass
+        _fast_copy(src, dst)
 
     def clear_images_dir(self):
-        for images_dir in self.images_dirs_list():
-            for path in images_dir.iterdir():
-                if path.is_file():
-                    os.unlink(path)
-                else:
-                    shutil.rmtree(path)
+        def clear(images_dir: Path) -> None:
+            with os.scandir(images_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        os.unlink(entry.path)
+                    else:
+                        shutil.rmtree(entry.path)
+
+        if not (images_dirs := self.images_dirs_list()):
+            return
+        max_workers = min(_FILE_WORKERS, len(images_dirs))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(clear, images_dirs):
+                pass
 
     def remove_old_tarballs(self):
-        with self.pushd(self.out_dir):
-            for tb in os.listdir():
-                lived = time.time() - os.path.getmtime(tb)
-                delta = datetime.timedelta(seconds=lived)
-                if delta > self.rebuild_after:
-                    os.unlink(tb)
+        deadline = time.time() - self.rebuild_after.total_seconds()
+        with os.scandir(self.out_dir) as it:
+            for entry in it:
+                if entry.stat().st_mtime < deadline:
+                    os.unlink(entry.path)
 
     def ensure_scripts(self, image):
         for name in self.created_scripts:
@@ -747,8 +1036,7 @@ Dir::Etc::preferencesparts "/var/empty";
 
         self.created_scripts = []
 
-        target_type = re.sub(r'(?:(\w+)/)?.*', r'\1',
-                             self.target_by_image(image))
+        target_type = _TARGET_TYPE_RE.sub(r'\1', self.target_by_image(image))
         if not target_type:
             target_type = 'distro'
         scripts_path = (
@@ -761,8 +1049,12 @@ Dir::Etc::preferencesparts "/var/empty";
         for name, content in self.scripts_by_image(image).items():
             script = scripts_path / name
             self.created_scripts.append(script)
-            script.write_text(content)
-            os.chmod(script, 0o755)
+            fd = os.open(script, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+            try:
+                os.fchmod(fd, 0o755)
+                os.write(fd, content.encode())
+            finally:
+                os.close(fd)
 
     def ensure_build_success(self) -> None:
         if self._build_errors:
@@ -774,92 +1066,159 @@ Dir::Etc::preferencesparts "/var/empty";
             self.error(msg)
         self.clear_images_dir()
         self.ensure_mkimage_profiles(self.force_recreate_mp)
+        with os.scandir(self.out_dir) as it:
+            self._out_mtimes = {
+                entry.name: entry.stat().st_mtime for entry in it
+            }
+
+        for image in self.images:
+            builds = [
+                (branch, arch, kind)
+                for branch in self.branches
+                if not self.skip_branch(image, branch)
+                for arch in self.arches_by_branch(branch)
+                if not self.skip_arch(image, arch)
+                for kind in self.kinds_by_image(image)
+            ]
+            if not builds:
+                continue
 
-        for branch in self.branches:
-            for image in self.images:
-                if self.skip_branch(image, branch):
-                    continue
-                self.ensure_scripts(image)
-                target = self.target_by_image(image)
+            self.ensure_scripts(image)
+            target = self.target_by_image(image)
+            size = self.size_by_image(image)
+
+            def build(branch, arch, kind):
                 branding = self.branding(image, branch)
-                for arch in self.arches_by_branch(branch):
-                    if self.skip_arch(image, arch):
+                return self.build_tarball(
+                    target, branding, branch, arch, kind, size
+                )
+
+            def store(tarballs):
+                for (branch, arch, kind), tarball in zip(builds, tarballs):
+                    if tarball is None:
                         continue
 
-                    for kind in self.kinds_by_image(image):
-                        size = self.size_by_image(image)
-                        tarball = self.build_tarball(
-                            target, branding, branch, arch, kind, size
-                        )
-                        if tarball is None:
-                            continue
-
-                        image_path = self.image_path(image, branch, arch, kind)
-                        self.copy_image(tarball, image_path)
-                        if not no_tests:
-                            for test in self.tests_by_image(image):
-                                self.info(f'Test {image} {branch} {arch}')
-                                if not cloud_build.image_tests.test(
-                                    image=image_path,
-                                    branch=branch,
-                                    arch=arch,
-                                    **test,
-                                ):
-                                    self.error(f'Test for {image} failed')
+                    image_path = self.image_path(image, branch, arch, kind)
+                    self.copy_image(tarball, image_path)
+                    if not no_tests:
+                        for test in self.tests_by_image(image):
+                            self.info(f'Test {image} {branch} {arch}')
+                            if not cloud_build.image_tests.test(
+                                image=image_path,
+                                branch=branch,
+                                arch=arch,
+                                **test,
+                            ):
+                                self.error(f'Test for {image} failed')
+
+            if self.jobs == 1:
+                # next build starts only after the previous one is stored
+                store(map(build, *zip(*builds)))
+                continue
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                try:
+                    store(_bounded_map(executor, build, builds, self.jobs))
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)
+                    raise
 
         self.ensure_build_success()
         self.remove_old_tarballs()
 
     def copy_external_files(self):
-        if not self.external_files:
+        if not (external_files := self.external_files):
             return
 
-        for branch in os.listdir(self.external_files):
+        def copy(branch: str, arch: str, image: str) -> None:
+            self.info(f'Copy external file {image} in {branch}/{arch}')
+            self.copy_image(
+                external_files / branch / arch / image,
+                self.images_dir(branch, arch) / image,
+                rewrite=True,
+            )
+
+        files = []
+        for branch in os.listdir(external_files):
             if branch not in self.branches:
                 self.error(f'Unknown branch {branch} in external_files')
             arches = self.arches_by_branch(branch)
-            for arch in os.listdir(self.external_files / branch):
+            for arch in os.listdir(external_files / branch):
                 if arch not in arches:
                     self.error(f'Unknown arch {arch} in external_files')
-                with self.pushd(self.external_files / branch / arch):
-                    for image in os.listdir():
-                        msg = f'Copy external file {image} in {branch}/{arch}'
-                        self.info(msg)
-                        self.copy_image(
-                            image,
-                            self.images_dir(branch, arch) / image,
-                            rewrite=True,
-                        )
+                for image in os.listdir(external_files / branch / arch):
+                    files.append((branch, arch, image))
+
+        if not files:
+            return
+        max_workers = min(_FILE_WORKERS, len(files))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(copy, *zip(*files)):
+                pass
 
     def sign(self):
-        if self.key is None:
+        if (key := self.key) is None:
             self.error('Pass key to config file for sign')
 
-        sum_file = self.checksum_command.upper()
-        for images_dir in self.images_dirs_list():
-            with self.pushd(images_dir):
-                files = [f
-                         for f in os.listdir()
-                         if not f.startswith(sum_file)]
-                string = ','.join(files)
+        sum_file = 'SHA256SUM'
+        generated_files = {
+            sum_file,
+            f'{sum_file}.asc',
+            'SHA256SUMS',
+            'SHA256SUMS.gpg',
+        }
 
-                cmd = [self.checksum_command] + files
-                self.info(f'Calculate checksum of {string}')
-                self.call(cmd, stdout_to_file=sum_file)
-                shutil.copyfile(sum_file, 'SHA256SUMS')
+        def sign_images_dir(images_dir: Path) -> None:
+            with os.scandir(images_dir) as it:
+                files = [entry.name
+                         for entry in it
+                         if entry.name not in generated_files]
+            string = ','.join(files)
+
+            self.info(f'Calculate checksum of {string}')
+            sum_path = images_dir / sum_file
+            with open(sum_path, 'w') as f:
+                f.write(sha256sum(files, images_dir))
+            self.copy_image(
+                sum_path,
+                images_dir / 'SHA256SUMS',
+                rewrite=True,
+            )
 
-                self.info(f'Sign checksum of {string}')
-                self.call(['gpg2', '--yes', '-basu', self.key, sum_file])
-                shutil.copyfile(sum_file + '.asc', 'SHA256SUMS.gpg')
+            self.info(f'Sign checksum of {string}')
+            self.call(['gpg2', '--yes', '-basu', key, str(sum_path)])
+            self.copy_image(
+                images_dir / f'{sum_file}.asc',
+                images_dir / 'SHA256SUMS.gpg',
+                rewrite=True,
+            )
+
+        if not (images_dirs := self.images_dirs_list()):
+            return
+        max_workers = min(_FILE_WORKERS, len(images_dirs))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(sign_images_dir, images_dirs):
+                pass
+
+    def ssh_options(self) -> List[str]:
+        """Options to reuse one ssh connection for all calls to remote"""
+        control_dir = self.data_dir / 'ssh'
+        os.makedirs(control_dir, exist_ok=True)
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={control_dir}/%C',
+            '-o', 'ControlPersist=60s',
+        ]
 
     def after_sync_commands(self):
         remote = self._remote
         colon = remote.find(':')
         if colon != -1:
             host = remote[:colon]
+            ssh_options = self.ssh_options()
 
             def cmd(command):
-                return ['ssh', host, command]
+                return ['ssh', *ssh_options, host, command]
         else:
             host = remote
 
@@ -870,7 +1229,7 @@ Dir::Etc::preferencesparts "/var/empty";
             self.call(cmd(command))
 
     def sync(self, create_remote_dirs: bool = False) -> None:
-        for images_dir, remote in self.images_dirs_remotes_list():
+        def sync_images_dir(images_dir: Path, remote: str) -> None:
             if create_remote_dirs:
                 os.makedirs(remote, exist_ok=True)
             cmd = [
@@ -881,6 +1240,18 @@ Dir::Etc::preferencesparts "/var/empty";
             ]
             if not self.no_delete:
                 cmd.append('--delete')
+            if ':' in remote:
+                cmd.extend(['-e', shlex.join(['ssh', *self.ssh_options()])])
             self.call(cmd)
 
+        if images_dirs_remotes := self.images_dirs_remotes_list():
+            max_workers = min(self.sync_jobs, len(images_dirs_remotes))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(sync_images_dir, images_dir, remote)
+                    for images_dir, remote in images_dirs_remotes
+                ]
+                for future in futures:
+                    future.result()
+
         self.after_sync_commands()
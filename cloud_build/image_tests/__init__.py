@@ -8,39 +8,39 @@ import tempfile
 from .lxd import test_lxd
 from .docker import test_docker
 
+_PROG_RE = re.compile(r'prog\(([-.\w]+)\)')
+_SUPPORTED_ARCHES = frozenset(['x86_64', 'i586'])
+
 
 @contextlib.contextmanager
-def pushtmpd():
-    previous_dir = os.getcwd()
+def tmpd():
     tmpdir = tempfile.mkdtemp()
     try:
-        os.chdir(tmpdir)
         yield tmpdir
     finally:
-        os.chdir(previous_dir)
         shutil.rmtree(tmpdir)
 
 
 def test(method, image, branch, arch):
     result = True
 
-    if arch not in ['x86_64', 'i586']:
+    if arch not in _SUPPORTED_ARCHES:
         return True
 
-    with pushtmpd() as tmpdir:
+    with tmpd() as tmpdir:
         image = shutil.copy(image, tmpdir)
         image_name = os.path.basename(image)
         if method == 'lxd':
             commands = test_lxd(image)
         elif method == 'docker':
-            commands = test_docker(image_name)
-        elif match := re.match(r'prog\(([-.\w]+)\)', method):
-            commands = [f"{match[1]} {image}"]
+            commands = test_docker(image_name, tmpdir)
+        elif match := _PROG_RE.match(method):
+            commands = [[match[1], image]]
         else:
             raise Exception(f'Undefined test method {method}')
 
         for command in commands:
-            rc = subprocess.call(command, shell=True)
+            rc = subprocess.call(command, cwd=tmpdir)
             if rc:
                 result = False
 
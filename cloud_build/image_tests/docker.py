@@ -1,30 +1,31 @@
 from typing import List
+from pathlib import Path
 
+import uuid
 
-def test_docker(image: str) -> List[str]:
-    dockerfile = rf"""FROM scratch
+_DOCKERFILE = """FROM scratch
 ADD {image} /
 
 RUN true > /etc/security/limits.d/50-defaults.conf
 
 CMD ["/bin/bash"]"""
+_TEST_COMMAND = ' && '.join([
+    'apt-get update',
+    'apt-get install -y vim-console',
+    '[ -L /var/run ]',
+    '[ -L /var/lock ]',
+])
 
-    with open('Dockerfile', 'w') as f:
-        f.write(dockerfile)
 
-    name = f'cloud_build_test_{abs(hash(image))}'
-    test_commads = [
-        'apt-get update',
-        'apt-get install -y vim-console',
-        '[ -L /var/run ]',
-        '[ -L /var/lock ]'
-    ]
-    test_commad = " && ".join(test_commads)
+def test_docker(image: str, workdir: str) -> List[List[str]]:
+    Path(workdir, 'Dockerfile').write_text(_DOCKERFILE.format(image=image))
+
+    # the tag only lives for the test, it just has to be unique
+    name = f'cloud_build_test_{uuid.uuid4().hex}'
     commands = [
-        f'docker build --rm --tag={name} .',
-        f"docker run --rm {name} /bin/sh -c "
-        f"'{test_commad}'",
-        f'docker image rm {name}',
+        ['docker', 'build', '--rm', f'--tag={name}', '.'],
+        ['docker', 'run', '--rm', name, '/bin/sh', '-c', _TEST_COMMAND],
+        ['docker', 'image', 'rm', name],
     ]
 
     return commands
@@ -1,5 +1,5 @@
 from typing import List
 
 
-def test_lxd(image: str) -> List[str]:
+def test_lxd(image: str) -> List[List[str]]:
     return []
@@ -1,18 +1,25 @@
-from typing import Dict
+from typing import Dict, Pattern
 
+import functools
 import re
 import subprocess
 
 
+@functools.lru_cache(maxsize=64)
+def _compiled(regex: str) -> Pattern:
+    return re.compile(regex)
+
+
 def rename(rename_dict: Dict[str, str], name: str) -> str:
     if regex := rename_dict.get('regex'):
         to = rename_dict['to']
-        name = re.sub(regex, to, name)
+        name = _compiled(regex).sub(to, name)
     elif prog := rename_dict.get('prog'):
         name = subprocess.run(
             [prog, name],
             stdout=subprocess.PIPE,
-        ).stdout.decode().strip()
+            text=True,
+        ).stdout.strip()
     else:
         to = rename_dict['to']
         name = to
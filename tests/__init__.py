@@ -0,0 +1,15 @@
+from typing import Optional
+
+import os
+
+try:
+    from yaml import CSafeDumper as YamlDumper  # noqa: F401
+    from yaml import CSafeLoader as YamlLoader  # noqa: F401
+except ImportError:
+    from yaml import SafeDumper as YamlDumper  # type: ignore # noqa: F401
+    from yaml import SafeLoader as YamlLoader  # type: ignore # noqa: F401
+
+# keep short-lived test trees in memory unless TMPDIR asks otherwise
+TMP_DIR: Optional[str] = None
+if 'TMPDIR' not in os.environ and os.access('/dev/shm', os.W_OK):
+    TMP_DIR = '/dev/shm'
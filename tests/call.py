@@ -1,5 +1,4 @@
 from pathlib import Path
-from collections.abc import Iterable
 
 import json
 import os
@@ -11,6 +10,7 @@ import time
 
 SUBPROCESS_CALL = subprocess.call
 DEFAULT = object()
+_TARGET_RE = re.compile(r'.*/([-\w]*)\.(.*)')
 
 
 def one_arg(args, kwargs):
@@ -21,14 +21,17 @@ def one_arg(args, kwargs):
 def _make_conditional_d(decorator_factory):
     def df(*df_args, cond=None, inverse=False, **df_kwargs):
         if cond is None:
+            if not inverse:
+                return decorator_factory(*df_args, **df_kwargs)
             cond = lambda x: True  # noqa E731
 
         def decorator(prog):
-            def f(args):
+            def f(args, **kwargs):
                 if cond(args) != inverse:
-                    return decorator_factory(*df_args, **df_kwargs)(prog)(args)
+                    func = decorator_factory(*df_args, **df_kwargs)(prog)
+                    return func(args, **kwargs)
                 else:
-                    return prog(args)
+                    return prog(args, **kwargs)
             return f
         return decorator
     return df
@@ -72,7 +75,7 @@ def print_d(func):
         sargs = list(args)
         sargs.extend(f'{k}={v}' for k, v in kwargs.items())
         print(f'{func.__name__}({sargs})', file=sys.stdout)
-        return func(*args)
+        return func(*args, **kwargs)
     return f
 
 
@@ -82,6 +85,7 @@ def print_d(func):
 def nop_d(func):
     def f(*args, **kwargs):
         pass
+    f.constant_rc = None
     return f
 
 
@@ -127,34 +131,46 @@ def return_d(rc):
         def f(*args, **kwargs):
             func(*args, **kwargs)
             return rc
+        # nothing is run under the decorator, so the result is a constant
+        if hasattr(func, 'constant_rc'):
+            f.constant_rc = rc
         return f
     return d
 
 
-def error_call(args):
+def error_call(args, **kwargs):
     raise Exception(f'Not implemened call for `{args}`')
 
 
-def git(args):
+def git(args, **kwargs):
     if args[1] == 'clone':
-        target = Path(args[3])
-        os.makedirs(target)
+        target = Path(args[-1])
         if target.name == 'mkimage-profiles':
             os.makedirs(target / 'conf.d')
-            os.makedirs(target / 'features.in/build-ve/image-scripts.d')
-    else:
+            (target / 'features.in/build-ve/image-scripts.d').mkdir(
+                parents=True,
+            )
+        else:
+            os.makedirs(target)
+    elif args[1] == 'pull':
+        git_dir = Path(kwargs['cwd'], '.git')
+        git_dir.mkdir(exist_ok=True)
+        (git_dir / 'FETCH_HEAD').touch()
+    elif args[1] not in ('remote', 'reset', 'clean'):
         error_call(args)
     return 0
 
 
-def make(args):
-    for arg in args:
-        if arg.startswith('IMAGE_OUTDIR='):
-            out_dir = Path(arg.lstrip('IMAGE_OUTDIR='))
-        if arg.startswith('ARCH='):
-            arch = Path(arg.lstrip('ARCH='))
+def make(args, **kwargs):
+    variables = dict(
+        arg.split('=', 1)
+        for arg in args
+        if '=' in arg and not arg.startswith('-')
+    )
+    out_dir = Path(variables['IMAGE_OUTDIR'])
+    arch = variables['ARCH']
 
-    match = re.match(r'.*/([-\w]*)\.(.*)', args[-1])
+    match = _TARGET_RE.match(args[-1])
     target, kind = match.groups()
     image = out_dir / f'{target}-{arch}.{kind}'
     image.write_text(json.dumps(args))
@@ -162,18 +178,21 @@ def make(args):
     return 0
 
 
-def gpg(args):
-    Path(f'{args[-1]}.asc').touch()
+def gpg(args, **kwargs):
+    os.close(os.open(f'{args[-1]}.asc', os.O_WRONLY | os.O_CREAT, 0o644))
     return 0
 
 
-def rsync(args):
-    return SUBPROCESS_CALL(args, stdout=subprocess.DEVNULL)
+def rsync(args, **kwargs):
+    return SUBPROCESS_CALL(args, stdout=subprocess.DEVNULL, **kwargs)
 
 
 def decorate(decorators, func):
     for decorator in reversed(decorators):
         func = decorator(func)
+    if hasattr(func, 'constant_rc'):
+        rc = func.constant_rc
+        return lambda args, **kwargs: rc
     return func
 
 
@@ -193,14 +212,18 @@ class Call():
 
         if decorators is None:
             decorators = {}
-        self.decorators = decorators
-
-    def __call__(self, args):
-        rc = None
-        prog = args[0]
-        func = self.progs.get(prog, self.progs.get(DEFAULT, error_call))
-        decorators = self.decorators.get(prog, [])
-        if not isinstance(decorators, Iterable):
-            decorators = [decorators]
-        rc = decorate(decorators, func)(args)
-        return rc
+        self.decorators = {
+            prog: d if isinstance(d, list) else [d]
+            for prog, d in decorators.items()
+        }
+
+        default = self.progs.get(DEFAULT, error_call)
+        self._dispatch = {DEFAULT: default}
+        for prog in self.progs.keys() | self.decorators.keys():
+            func = self.progs.get(prog, default)
+            decorators = self.decorators.get(prog, [])
+            self._dispatch[prog] = decorate(decorators, func)
+
+    def __call__(self, args, **kwargs):
+        func = self._dispatch.get(args[0], self._dispatch[DEFAULT])
+        return func(args, **kwargs)
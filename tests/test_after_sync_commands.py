@@ -2,12 +2,14 @@ from pathlib import Path
 from unittest import TestCase
 from unittest import mock
 
+import shlex
 import tempfile
 import shutil
 
 from cloud_build import CB
 
 import tests.call as call
+from tests import TMP_DIR
 
 
 DS = {'rsync': [call.return_d(0), call.nop_d]}
@@ -15,17 +17,28 @@ DS = {'rsync': [call.return_d(0), call.nop_d]}
 
 class TestAfterSyncCommands(TestCase):
     def setUp(self):
-        self.data_dir = Path(tempfile.mkdtemp(prefix='cloud_build'))
+        self.data_dir = Path(tempfile.mkdtemp(
+            prefix='cloud_build',
+            dir=TMP_DIR,
+        ))
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.rsyncs = []
 
-    def tearDown(self):
-        shutil.rmtree(self.data_dir)
+        def rsync(args, **kwargs):
+            self.rsyncs.append(args)
+            return 0
+
+        self.call = call.Call(progs={'rsync': rsync})
 
-    @mock.patch('subprocess.call', call.Call(decorators=DS))
     def test_run_after_sync_remote_commands(self):
+        patcher = mock.patch('subprocess.call', self.call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         cb = CB(
             config='tests/test_run_after_sync_remote_commands.yaml',
             data_dir=self.data_dir,
         )
+        self.addCleanup(cb.close)
         cb.create_images(no_tests=True)
         regex = r'ssh.*kick'
         self.assertRaisesRegex(
@@ -34,13 +47,21 @@ class TestAfterSyncCommands(TestCase):
             cb.sync,
             create_remote_dirs=True
         )
+        [rsync] = self.rsyncs
+        self.assertEqual(rsync[-2], '-e')
+        ssh = shlex.split(rsync[-1])
+        self.assertEqual(ssh[0], 'ssh')
+        self.assertIn('ControlMaster=auto', ssh)
 
-    @mock.patch('subprocess.call', call.Call(decorators=DS))
     def test_run_after_sync_local_commands(self):
+        patcher = mock.patch('subprocess.call', self.call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         cb = CB(
             config='tests/test_run_after_sync_local_commands.yaml',
             data_dir=self.data_dir,
         )
+        self.addCleanup(cb.close)
         cb.create_images(no_tests=True)
         regex = r'\[\'kick'
         self.assertRaisesRegex(
@@ -49,6 +70,8 @@ class TestAfterSyncCommands(TestCase):
             cb.sync,
             create_remote_dirs=True
         )
+        [rsync] = self.rsyncs
+        self.assertNotIn('-e', rsync)
 
     @mock.patch('subprocess.call', call.Call(decorators=DS))
     def test_dont_run_after_sync_local_commands(self):
@@ -56,5 +79,6 @@ class TestAfterSyncCommands(TestCase):
             config='tests/minimal_config.yaml',
             data_dir=self.data_dir,
         )
+        self.addCleanup(cb.close)
         cb.create_images(no_tests=True)
         cb.sync(create_remote_dirs=False)
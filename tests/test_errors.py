@@ -4,6 +4,7 @@ from unittest import mock
 import os
 import shutil
 import tempfile
+import threading
 
 import yaml
 
@@ -11,6 +12,13 @@ from cloud_build import CB
 from cloud_build import Error, BuildError, MultipleBuildErrors
 
 import tests.call as call
+from tests import TMP_DIR, YamlDumper, YamlLoader
+
+
+with open('tests/minimal_config.yaml') as f:
+    _MINIMAL_CFG = yaml.load(f, Loader=YamlLoader)
+
+CALL = call.Call()
 
 
 def update(old_dict, kwargs):
@@ -24,16 +32,39 @@ def update(old_dict, kwargs):
 
 
 class TestErrors(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._prebuilt = tempfile.mkdtemp(
+            prefix='cloud_build_prebuilt',
+            dir=TMP_DIR,
+        )
+        with mock.patch('subprocess.call', CALL):
+            with CB(
+                config='tests/minimal_config.yaml',
+                data_dir=cls._prebuilt,
+            ) as cloud_build:
+                cloud_build.create_images(no_tests=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._prebuilt)
+
     def setUp(self):
         kwargs = {}
-        kwargs['data_dir'] = tempfile.mkdtemp(prefix='cloud_build_data')
+        kwargs['data_dir'] = tempfile.mkdtemp(
+            prefix='cloud_build_data',
+            dir=TMP_DIR,
+        )
+        self.addCleanup(shutil.rmtree, kwargs['data_dir'])
         self.kwargs = kwargs
-        self.images_dir = tempfile.mkdtemp(prefix='cloud_build_images')
+        self.images_dir = tempfile.mkdtemp(
+            prefix='cloud_build_images',
+            dir=TMP_DIR,
+        )
+        self.addCleanup(shutil.rmtree, self.images_dir)
         self.config = None
 
     def tearDown(self):
-        shutil.rmtree(self.kwargs['data_dir'])
-        shutil.rmtree(self.images_dir)
         if (config := self.config) is not None:
             os.unlink(config)
 
@@ -49,16 +80,15 @@ class TestErrors(TestCase):
 
     def test_required_parameters_in_config(self):
         self.config = tempfile.mktemp(prefix='cb_conf')
-        with open('tests/minimal_config.yaml') as f:
-            cfg = yaml.safe_load(f)
-
         for parameter in ['remote', 'images', 'branches']:
-            with open(self.config, 'w') as f:
-                yaml.safe_dump(update(cfg, {parameter: None}), f)
+            with self.subTest(parameter=parameter):
+                cfg = update(_MINIMAL_CFG, {parameter: None})
+                with open(self.config, 'w') as f:
+                    yaml.dump(cfg, f, Dumper=YamlDumper)
 
-            regex = f'parameter.*{parameter}'
-            self.kwargs.update(config=self.config)
-            self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
+                regex = f'parameter.*{parameter}'
+                self.kwargs.update(config=self.config)
+                self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
 
     def test_override_required_parameters_in_config(self):
         self.config = tempfile.mktemp(prefix='cb_conf')
@@ -67,22 +97,36 @@ class TestErrors(TestCase):
             'images': {},
             'branches': {},
         }
-        with open('tests/minimal_config.yaml') as f:
-            cfg = yaml.safe_load(f)
-
         for parameter in ['remote', 'images', 'branches']:
-            with open(self.config, 'w') as f:
-                yaml.safe_dump(update(cfg, {parameter: None}), f)
+            with self.subTest(parameter=parameter):
+                cfg = update(_MINIMAL_CFG, {parameter: None})
+                with open(self.config, 'w') as f:
+                    yaml.dump(cfg, f, Dumper=YamlDumper)
 
-            self.kwargs.update(config=self.config)
-            self.kwargs.update(config_override=config_override)
-            CB(**self.kwargs)
+                self.kwargs.update(config=self.config)
+                self.kwargs.update(config_override=config_override)
+                CB(**self.kwargs).close()
+
+    def test_image_without_kinds(self):
+        images = {'rootfs-minimal': {'target': 've/docker'}}
+        self.kwargs.update(config='tests/minimal_config.yaml')
+        self.kwargs.update(config_override={'images': images, 'key': 0})
+        with mock.patch('subprocess.call', CALL), CB(**self.kwargs) as cb:
+            cb.sign()
 
     def test_run_already_running(self):
         self.kwargs.update(config='tests/minimal_config.yaml')
-        cb = CB(**self.kwargs)  # noqa F841
-        regex = 'already running'
-        self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
+        with CB(**self.kwargs):
+            regex = f'already running.*pid {os.getpid()}'
+            self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
+
+    def test_run_wait_lock(self):
+        self.kwargs.update(config='tests/minimal_config.yaml')
+        cb = CB(**self.kwargs)
+        timer = threading.Timer(0.1, cb.close)
+        timer.start()
+        self.addCleanup(timer.join)
+        CB(**self.kwargs, lock_timeout=10).close()
 
     def test_try_build_all_zero_rc(self):
         def cond(args):
@@ -93,6 +137,7 @@ class TestErrors(TestCase):
                 config='tests/test_try_build_all.yaml',
                 data_dir=self.kwargs['data_dir'],
             )
+            self.addCleanup(cloud_build.close)
             regex = r'build.*:'
             self.assertRaisesRegex(
                 MultipleBuildErrors,
@@ -110,6 +155,7 @@ class TestErrors(TestCase):
                 config='tests/test_try_build_all.yaml',
                 data_dir=self.kwargs['data_dir'],
             )
+            self.addCleanup(cloud_build.close)
             regex = r'build.*:'
             self.assertRaisesRegex(
                 MultipleBuildErrors,
@@ -127,6 +173,7 @@ class TestErrors(TestCase):
                 config='tests/test_not_try_build_all.yaml',
                 data_dir=self.kwargs['data_dir'],
             )
+            self.addCleanup(cloud_build.close)
             regex = r'build.*aarch64'
             self.assertRaisesRegex(
                 BuildError,
@@ -135,18 +182,52 @@ class TestErrors(TestCase):
                 no_tests=True
             )
 
+    def test_not_try_build_all_stops_building(self):
+        makes = []
+
+        def make(args, **kwargs):
+            makes.append(args)
+            return 1
+
+        for jobs in [1, 2]:
+            makes.clear()
+            with self.subTest(jobs=jobs), mock.patch(
+                'subprocess.call',
+                call.Call(progs={'make': make}),
+            ), CB(
+                config='tests/test_not_try_build_all.yaml',
+                data_dir=self.kwargs['data_dir'],
+                config_override={'jobs': jobs},
+            ) as cloud_build:
+                self.assertRaises(
+                    BuildError,
+                    cloud_build.create_images,
+                    no_tests=True
+                )
+                # only builds already in flight may finish
+                self.assertLessEqual(len(makes), jobs)
+
     def test_rebuild_after_format(self):
         regex = 'years.*rebuild_after'
         self.kwargs.update(config='tests/test_rebuild_after_format.yaml')
         self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
 
+    def test_jobs_should_be_positive(self):
+        self.kwargs.update(config='tests/minimal_config.yaml')
+        for jobs in [0, -1, 'two']:
+            with self.subTest(jobs=jobs):
+                self.kwargs.update(config_override={'jobs': jobs})
+                regex = 'jobs.*positive integer'
+                self.assertRaisesRegex(Error, regex, CB, **self.kwargs)
+
     def test_bad_size(self):
-        with mock.patch('subprocess.call', call.Call()):
+        with mock.patch('subprocess.call', CALL):
             regex = 'Bad size.*'
             cloud_build = CB(
                 config='tests/test_bad_size.yaml',
                 data_dir=self.kwargs['data_dir'],
             )
+            self.addCleanup(cloud_build.close)
             self.assertRaisesRegex(
                 Error,
                 regex,
@@ -154,24 +235,44 @@ class TestErrors(TestCase):
                 no_tests=True
             )
 
+    def test_bad_size_values(self):
+        for size in [-5, True, '\N{SUPERSCRIPT TWO}']:
+            image = {'target': 've/docker', 'kinds': ['tar.xz'], 'size': size}
+            override = {'images': {'rootfs-minimal': image}}
+            with self.subTest(size=size), CB(
+                config='tests/test_bad_size.yaml',
+                data_dir=self.kwargs['data_dir'],
+                config_override=override,
+            ) as cloud_build:
+                self.assertRaisesRegex(
+                    Error,
+                    'Bad size.*',
+                    cloud_build.size_by_image,
+                    'rootfs-minimal',
+                )
+
     def test_sign_requires_key(self):
-        with mock.patch('subprocess.call', call.Call()):
+        data_dir = self.kwargs['data_dir']
+        shutil.copytree(self._prebuilt, data_dir, dirs_exist_ok=True)
+        with mock.patch('subprocess.call', CALL):
             regex = 'key.*config'
             cloud_build = CB(
                 config='tests/minimal_config.yaml',
-                data_dir=self.kwargs['data_dir'],
+                data_dir=data_dir,
             )
-            cloud_build.create_images(no_tests=True)
+            self.addCleanup(cloud_build.close)
             self.assertRaisesRegex(Error, regex, cloud_build.sign)
 
     def test_sign_override_key(self):
-        with mock.patch('subprocess.call', call.Call()):
+        data_dir = self.kwargs['data_dir']
+        shutil.copytree(self._prebuilt, data_dir, dirs_exist_ok=True)
+        with mock.patch('subprocess.call', CALL):
             cloud_build = CB(
                 config='tests/minimal_config.yaml',
-                data_dir=self.kwargs['data_dir'],
+                data_dir=data_dir,
                 config_override={'key': 0},
             )
-            cloud_build.create_images(no_tests=True)
+            self.addCleanup(cloud_build.close)
             cloud_build.sign()
 
     def test_skiped_build(self):
@@ -181,6 +282,7 @@ class TestErrors(TestCase):
                 data_dir=self.kwargs['data_dir'],
                 built_images_dir=self.images_dir,
             )
+            self.addCleanup(cloud_build.close)
             regex = r'build.*skip'
             self.assertRaisesRegex(
                 Error,
@@ -1,27 +1,43 @@
-from collections import defaultdict
-from contextlib import ExitStack
 from pathlib import Path
 from unittest import TestCase
 from unittest import mock
 
+import functools
 import json
 import os
-import shutil
+import tempfile
 
 from parameterized import parameterized, parameterized_class  # type: ignore
 
 import yaml
 
 from cloud_build import CB
+from tests import YamlDumper, YamlLoader
 from tests.call import Call
 
 
-def change(origin, new, key, value):
-    with open(origin) as f:
-        cfg = yaml.safe_load(f)
+with open('tests/test_integration_images.yaml') as f:
+    _BASE_CFG = yaml.load(f, Loader=YamlLoader)
 
+
+def change(new, **values):
     with open(new, 'w') as f:
-        yaml.safe_dump(cfg | {key: value}, f)
+        yaml.dump(_BASE_CFG | values, f, Dumper=YamlDumper)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_make_args(path):
+    return json.loads(path.read_text())
+
+
+def _names(path):
+    with os.scandir(path) as it:
+        return frozenset(entry.name for entry in it)
+
+
+def _subdirs(path):
+    with os.scandir(path) as it:
+        return [entry.name for entry in it if entry.is_dir()]
 
 
 def get_class_name(cls, num, params_dict):
@@ -40,41 +56,39 @@ def get_class_name(cls, num, params_dict):
     {'branch': '', 'arch': ''},
 ], class_name_func=get_class_name)
 class TestIntegrationImages(TestCase):
-    def setUp(self):
-        self._images = self.__class__._images
-        self.images_dir = self.__class__.images_dir
+    images_dir: Path
+    _images: dict
 
     @classmethod
     def setUpClass(cls):
-        cls.work_dir = Path('/tmp/cloud-build')
-        shutil.rmtree(cls.work_dir, ignore_errors=True)
-        os.makedirs(cls.work_dir / 'external_files/p9/x86_64', exist_ok=True)
+        cls._tmp = tempfile.TemporaryDirectory(
+            prefix='cloud-build-',
+            ignore_cleanup_errors=True,
+        )
+        cls.work_dir = Path(cls._tmp.name)
+        os.makedirs(cls.work_dir / 'external_files/p9/x86_64')
         readme = cls.work_dir / 'external_files/p9/x86_64/README'
         readme.write_text('README')
         os.symlink(readme, readme.with_suffix(".txt"))
         config = cls.work_dir / 'config.yaml'
         branch = cls.branch
         arch = cls.arch
-        remote = Path('/tmp/cloud-build/images')
+        remote = cls.work_dir / 'images'
         if branch:
             remote = remote / '{branch}'
         if arch:
             remote = remote / '{arch}'
         remote = (remote / 'cloud').as_posix()
         change(
-            'tests/test_integration_images.yaml',
             config,
-            'remote',
-            remote,
+            remote=remote,
+            external_files=(cls.work_dir / 'external_files').as_posix(),
         )
 
-        with ExitStack() as stack:
-            stack.enter_context(mock.patch('subprocess.call', Call()))
-
-            cloud_build = CB(
-                config=config,
-                data_dir=(cls.work_dir / 'cloud_build').as_posix(),
-            )
+        with mock.patch('subprocess.call', Call()), CB(
+            config=config,
+            data_dir=(cls.work_dir / 'cloud_build').as_posix(),
+        ) as cloud_build:
             cloud_build.create_images(no_tests=True)
             cloud_build.copy_external_files()
             cloud_build.sign()
@@ -82,57 +96,54 @@ class TestIntegrationImages(TestCase):
 
         images_dir = cls.work_dir / 'images'
         cls.images_dir = images_dir
-        images = defaultdict(lambda: defaultdict(list))
+        images = {}
 
         if branch:
-            for branch in os.listdir(images_dir):
+            for branch in _subdirs(images_dir):
                 if arch:
-                    for arch in os.listdir(images_dir / branch):
-                        images[branch][arch] = os.listdir(
+                    for arch in _subdirs(images_dir / branch):
+                        images[branch, arch] = _names(
                             images_dir / branch / arch / 'cloud'
                         )
                 else:
-                    images[branch]['arch'] = os.listdir(
+                    images[branch, 'arch'] = _names(
                         images_dir / branch / 'cloud'
                     )
         elif arch:
-            for arch in os.listdir(images_dir):
-                images['branch'][arch] = os.listdir(
-                    images_dir / arch / 'cloud'
-                )
+            for arch in _subdirs(images_dir):
+                images['branch', arch] = _names(images_dir / arch / 'cloud')
         else:
-            images['branch']['arch'] = os.listdir(
-                images_dir / 'cloud'
-            )
+            images['branch', 'arch'] = _names(images_dir / 'cloud')
         cls._images = images
+        cls.number_of_images = sum(len(lst) for lst in images.values())
+        sums = cls.image_path('p9', 'x86_64', 'SHA256SUMS').read_text()
+        cls.number_of_sums = len(sums.splitlines())
 
-    def image_path(self, branch, arch, image) -> Path:
-        images_dir = self.images_dir
-        if self.branch:  # type: ignore
+    @classmethod
+    def image_path(cls, branch, arch, image) -> Path:
+        images_dir = cls.images_dir
+        if cls.branch:  # type: ignore
             images_dir = images_dir / branch
-        if self.arch:  # type: ignore
+        if cls.arch:  # type: ignore
             images_dir = images_dir / arch
 
         return images_dir / 'cloud' / image
 
-    def images(self, branch, arch) -> list:
+    def images(self, branch, arch) -> frozenset:
         if not self.branch:  # type: ignore
             branch = 'branch'
         if not self.arch:  # type: ignore
             arch = 'arch'
 
-        return self._images[branch][arch]
+        return self._images.get((branch, arch), frozenset())
 
-    def images_lists(self) -> list:
-        result = []
-        for branch_value in self._images.values():
-            for arch_value in branch_value.values():
-                result.append(arch_value)
-        return result
+    def images_lists(self):
+        return self._images.values()
 
     @classmethod
     def tearDownClass(cls):
-        shutil.rmtree(cls.work_dir, ignore_errors=True)
+        _load_make_args.cache_clear()
+        cls._tmp.cleanup()
 
     def test_arch_ppc64le(self):
         self.assertIn('alt-p9-rootfs-minimal-ppc64le.tar.xz',
@@ -140,10 +151,11 @@ class TestIntegrationImages(TestCase):
 
     def test_branches(self):
         if self.branch:
-            self.assertCountEqual(self._images.keys(),
+            self.assertCountEqual({branch for branch, _ in self._images},
                                   ['Sisyphus', 'p9', 'p8'])
         else:
-            self.assertCountEqual(self._images.keys(), ['branch'])
+            self.assertCountEqual({branch for branch, _ in self._images},
+                                  ['branch'])
 
     def test_build_cloud_img(self):
         self.assertIn('alt-p9-cloud-x86_64.img', self.images('p9', 'x86_64'))
@@ -160,8 +172,7 @@ class TestIntegrationImages(TestCase):
                          self.images('p9', 'ppc64le'))
 
     def get_make_args(self, branch, arch, image):
-        image = self.image_path(branch, arch, image)
-        return json.loads(image.read_text())
+        return _load_make_args(self.image_path(branch, arch, image))
 
     def test_branch_sisyphus_cloud(self):
         self.assertIn(
@@ -190,24 +201,20 @@ class TestIntegrationImages(TestCase):
         )
 
     def test_branding_absent_p9_workstation_cloud(self):
-        self.assertNotRegex(
-            ' '.join(self.get_make_args(
-                'p9',
-                'x86_64',
-                'alt-p9-workstation-cloud-x86_64.qcow2',
-            )),
-            'BRANDING'
+        make_args = self.get_make_args(
+            'p9',
+            'x86_64',
+            'alt-p9-workstation-cloud-x86_64.qcow2',
         )
+        self.assertFalse(any('BRANDING' in arg for arg in make_args))
 
     def test_branding_absent_sisyphus_cloud(self):
-        self.assertNotRegex(
-            ' '.join(self.get_make_args(
-                'Sisyphus',
-                'x86_64',
-                'alt-sisyphus-cloud-x86_64.qcow2',
-            )),
-            'BRANDING'
+        make_args = self.get_make_args(
+            'Sisyphus',
+            'x86_64',
+            'alt-sisyphus-cloud-x86_64.qcow2',
         )
+        self.assertFalse(any('BRANDING' in arg for arg in make_args))
 
     def test_external_files(self):
         self.assertIn('README', self.images('p9', 'x86_64'))
@@ -221,17 +228,11 @@ class TestIntegrationImages(TestCase):
             self.assertIn('SHA256SUMS', images_list)
             self.assertIn('SHA256SUMS.gpg', images_list)
 
-        number_of_images = len(self.image_path(
-            'p9',
-            'x86_64',
-            'SHA256SUMS',
-        ).read_text().splitlines())
         index = bool(self.branch) * 2 + bool(self.arch)
         expected_numbers = [59, 20, 25, 9]
-        self.assertEqual(number_of_images, expected_numbers[index])
+        self.assertEqual(self.number_of_sums, expected_numbers[index])
 
     def test_number_of_images(self):
-        number_of_images = sum(len(lst) for lst in self.images_lists())
         index = bool(self.branch) * 2 + bool(self.arch)
         expected_numbers = [63, 79, 71, 103]
-        self.assertEqual(number_of_images, expected_numbers[index])
+        self.assertEqual(self.number_of_images, expected_numbers[index])
@@ -0,0 +1,109 @@
+from pathlib import Path
+from unittest import TestCase
+from unittest import mock
+
+import os
+import tempfile
+import time
+
+from cloud_build import CB
+
+import tests.call as call
+from tests import TMP_DIR
+
+
+REMOTE_UPDATE = ['git', 'remote', 'update', '--prune']
+PULL = ['git', 'pull', '--ff-only']
+
+
+class TestMkimageProfiles(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory(prefix='cloud_build', dir=TMP_DIR)
+        self.addCleanup(tmp.cleanup)
+        self.data_dir = Path(tmp.name)
+        self.mp_dir = self.data_dir / 'work' / 'mkimage-profiles'
+        self.commands = []
+
+        def git(args, **kwargs):
+            self.commands.append(args)
+            return call.git(args, **kwargs)
+
+        patcher = mock.patch('subprocess.call', call.Call(progs={'git': git}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ensure(self, **kwargs):
+        """Run ensure_mkimage_profiles and return git commands it called"""
+        with CB(
+            config='tests/minimal_config.yaml',
+            data_dir=self.data_dir,
+            **kwargs,
+        ) as cb:
+            self.commands.clear()
+            cb.ensure_mkimage_profiles()
+            return list(self.commands)
+
+    def mirror(self):
+        mirrors = list((self.data_dir / 'git-cache').glob('*.git'))
+        self.assertEqual(len(mirrors), 1)
+        return mirrors[0]
+
+    def age(self, path, seconds):
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+    def test_clone_from_new_mirror(self):
+        commands = self.ensure()
+        mirror = str(self.mirror())
+        self.assertEqual(commands[0][:3], ['git', 'clone', '--mirror'])
+        self.assertEqual(commands[0][-1], mirror)
+        self.assertEqual(
+            commands[1],
+            ['git', 'clone', '--single-branch', mirror, str(self.mp_dir)],
+        )
+
+    def test_fresh_mirror_not_updated(self):
+        self.ensure()
+        commands = self.ensure()
+        self.assertNotIn(REMOTE_UPDATE, commands)
+        self.assertIn(PULL, commands)
+
+    def test_stale_mirror_updated(self):
+        self.ensure()
+        mirror = self.mirror()
+        self.age(mirror, 2 * 3600)
+        commands = self.ensure()
+        self.assertIn(REMOTE_UPDATE, commands)
+        self.assertLess(time.time() - os.path.getmtime(mirror), 3600)
+
+    def test_update_stays_on_branch(self):
+        commands = self.ensure(
+            config_override={'mkimage_profiles_branch': 'topic'},
+        )
+        self.assertIn('topic', commands[-1])
+
+        commands = self.ensure()
+        mirror = str(self.mirror())
+        self.assertEqual(commands, [
+            ['git', 'remote', 'set-url', 'origin', mirror],
+            PULL,
+        ])
+
+    def test_unchanged_mirror_skips_pull(self):
+        self.ensure()
+        self.ensure()
+        commands = self.ensure()
+        self.assertNotIn(REMOTE_UPDATE, commands)
+        self.assertNotIn(PULL, commands)
+
+    def test_updated_mirror_pulled(self):
+        self.ensure()
+        self.ensure()
+        self.age(self.mirror(), 3 * 3600)
+        self.age(self.mp_dir / '.git' / 'FETCH_HEAD', 2 * 3600)
+        commands = self.ensure()
+        self.assertEqual(commands, [
+            REMOTE_UPDATE,
+            ['git', 'remote', 'set-url', 'origin', str(self.mirror())],
+            PULL,
+        ])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+from unittest import mock
+
+import tempfile
+
+from cloud_build import CB
+
+import tests.call as call
+from tests import TMP_DIR
+
+
+CALL = call.Call()
+
+
+class TestNoBranches(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory(prefix='cloud_build', dir=TMP_DIR)
+        self.addCleanup(tmp.cleanup)
+        self.cb = CB(
+            config='tests/test_no_branches.yaml',
+            data_dir=tmp.name,
+        )
+        self.addCleanup(self.cb.close)
+
+    @mock.patch('subprocess.call', CALL)
+    def test_create_images(self):
+        self.cb.create_images(no_tests=True)
+
+    @mock.patch('subprocess.call', CALL)
+    def test_sign(self):
+        self.cb.sign()
+
+    @mock.patch('subprocess.call', CALL)
+    def test_sync(self):
+        self.cb.sync()
@@ -8,19 +8,27 @@ import tempfile
 from cloud_build import CB
 
 import tests.call as call
+from tests import TMP_DIR
+
+
+CALL = call.Call()
 
 
 class TestNoDelete(TestCase):
     def setUp(self):
-        self.data_dir = Path(tempfile.mkdtemp(prefix='cloud_build'))
+        self.tmp = tempfile.TemporaryDirectory(
+            prefix='cloud_build',
+            dir=TMP_DIR,
+        )
+        self.data_dir = Path(self.tmp.name)
         self.images_dir = Path('/tmp/cloud-build-test_no_delete/')
         self.images_dir.mkdir()
 
     def tearDown(self):
-        shutil.rmtree(self.data_dir)
+        self.tmp.cleanup()
         shutil.rmtree(self.images_dir)
 
-    @mock.patch('subprocess.call', call.Call())
+    @mock.patch('subprocess.call', CALL)
     def test_no_delete_false(self):
         cb = CB(
             config='tests/test_no_delete_false.yaml',
@@ -30,12 +38,12 @@ class TestNoDelete(TestCase):
         other_file.write_text('Some text')
         cb.create_images(no_tests=True)
         cb.sync(create_remote_dirs=True)
-        del cb
+        cb.close()
         msg = 'Other files shoud be deleted if not no_delete'
         if other_file.exists():
             self.fail(msg)
 
-    @mock.patch('subprocess.call', call.Call())
+    @mock.patch('subprocess.call', CALL)
     def test_no_delete_true(self):
         cb = CB(
             config='tests/test_no_delete_true.yaml',
@@ -45,7 +53,7 @@ class TestNoDelete(TestCase):
         other_file.write_text('Some text')
         cb.create_images(no_tests=True)
         cb.sync(create_remote_dirs=True)
-        del cb
+        cb.close()
         msg = 'Other files shoud not be deleted if no_delete'
         if not other_file.exists():
             self.fail(msg)
@@ -1,63 +1,53 @@
 from unittest import TestCase
 from unittest import mock
 
-import shutil
 import tempfile
 
 from cloud_build import CB
+from tests import TMP_DIR
 from tests.call import Call
 
 
+CALL = Call()
+CONFIGS = ['packages_all', 'packages_external', 'packages_image']
+
+
 class TestPackages(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.lines = {}
+        conf_mk = 'mkimage-profiles/conf.d/cloud-build.mk'
+        with mock.patch('subprocess.call', CALL):
+            for config in CONFIGS:
+                tmp = tempfile.TemporaryDirectory(
+                    prefix='cloud_build',
+                    dir=TMP_DIR,
+                )
+                cls.addClassCleanup(tmp.cleanup)
+                with CB(
+                    data_dir=tmp.name,
+                    config=f'tests/{config}.yaml',
+                ) as cb:
+                    cb.ensure_mkimage_profiles()
+                    conf = cb.work_dir / conf_mk
+                    cls.lines[config] = set(conf.read_text().splitlines())
+
     def setUp(self):
-        self.data_dir = tempfile.mkdtemp(prefix='cloud_build')
-        self.conf_mk = 'mkimage-profiles/conf.d/cloud-build.mk'
         self.package_lines = [
             '\t@$(call add,BASE_PACKAGES,vim-console)',
             '\t@$(call add,BASE_PACKAGES,gosu)'
         ]
 
-    def tearDown(self):
-        shutil.rmtree(self.data_dir)
+    def check_packages(self, config):
+        lines = self.lines[config]
+        for package_line in self.package_lines:
+            self.assertIn(package_line, lines)
 
     def test_packages_all(self):
-        with mock.patch('subprocess.call', Call()):
-            cb = CB(
-                data_dir=self.data_dir,
-                config='tests/packages_all.yaml'
-            )
-            cb.ensure_mkimage_profiles()
-
-            conf = cb.work_dir / self.conf_mk
-            lines = conf.read_text().splitlines()
-
-            for package_line in self.package_lines:
-                self.assertIn(package_line, lines)
+        self.check_packages('packages_all')
 
     def test_packages_external(self):
-        with mock.patch('subprocess.call', Call()):
-            cb = CB(
-                data_dir=self.data_dir,
-                config='tests/packages_external.yaml'
-            )
-            cb.ensure_mkimage_profiles()
-
-            conf = cb.work_dir / self.conf_mk
-            lines = conf.read_text().splitlines()
-
-            for package_line in self.package_lines:
-                self.assertIn(package_line, lines)
+        self.check_packages('packages_external')
 
     def test_packages_images(self):
-        with mock.patch('subprocess.call', Call()):
-            cb = CB(
-                data_dir=self.data_dir,
-                config='tests/packages_image.yaml'
-            )
-            cb.ensure_mkimage_profiles()
-
-            conf = cb.work_dir / self.conf_mk
-            lines = conf.read_text().splitlines()
-
-            for package_line in self.package_lines:
-                self.assertIn(package_line, lines)
+        self.check_packages('packages_image')
@@ -3,7 +3,6 @@ from unittest import TestCase
 from unittest import mock
 
 import os
-import shutil
 import tempfile
 import time
 
@@ -11,47 +10,55 @@ from cloud_build import CB
 from cloud_build import BuildError
 
 import tests.call as call
+from tests import TMP_DIR
 
 
 DS = {'make': [call.return_d(0), call.nop_d]}
+CALL = call.Call()
+CALL_DS = call.Call(decorators=DS)
 
 
 class TestRebuild(TestCase):
     def setUp(self):
-        self.data_dir = Path(tempfile.mkdtemp(prefix='cloud_build'))
+        self.tmp = tempfile.TemporaryDirectory(
+            prefix='cloud_build',
+            dir=TMP_DIR,
+        )
+        self.data_dir = Path(self.tmp.name)
         self.cb = CB(
             config='tests/test_rebuild.yaml',
             data_dir=self.data_dir,
         )
 
     def tearDown(self):
-        shutil.rmtree(self.data_dir)
+        self.cb.close()
+        self.tmp.cleanup()
 
-    @mock.patch('subprocess.call', call.Call(decorators=DS))
+    @mock.patch('subprocess.call', CALL_DS)
     def test_do_rebuild(self):
         tarball = self.data_dir / 'out/docker_Sisyphus-x86_64.tar.xz'
         tarball.touch()
-        two_hours_ago = time.time() - 2*60*60
-        os.utime(tarball, times=(two_hours_ago, two_hours_ago))
+        two_hours_ago = time.time_ns() - 2*60*60 * 10**9
+        os.utime(tarball, ns=(two_hours_ago, two_hours_ago))
         msg = 'Do not try to rebuild with outdated cache'
         with self.assertRaises(BuildError, msg=msg):
             self.cb.create_images(no_tests=True)
 
-    @mock.patch('subprocess.call', call.Call(decorators=DS))
+    @mock.patch('subprocess.call', CALL_DS)
     def test_do_force_rebuild(self):
         tarball = self.data_dir / 'out/docker_Sisyphus-x86_64.tar.xz'
         tarball.touch()
-        del self.cb
-        cb = CB(
+        self.cb.close()
+        self.cb = CB(
             config='tests/test_rebuild.yaml',
             data_dir=self.data_dir,
             config_override={'rebuild_after': {'days': 0}},
         )
         msg = 'Do not try to rebuild when force_rebuild'
         with self.assertRaises(BuildError, msg=msg):
-            cb.create_images(no_tests=True)
+            self.cb.create_images(no_tests=True)
 
-    @mock.patch('subprocess.call', call.Call(decorators=DS))
+    @mock.patch('subprocess.call', CALL_DS)
     def test_dont_rebuild(self):
         tarball = self.data_dir / 'out/docker_Sisyphus-x86_64.tar.xz'
         tarball.touch()
@@ -61,7 +68,7 @@ class TestRebuild(TestCase):
         except BuildError:
             self.fail(msg)
 
-    @mock.patch('subprocess.call', call.Call())
+    @mock.patch('subprocess.call', CALL)
     def test_dont_create_image_when_rebuild(self):
         tarball = self.data_dir / 'out/docker_Sisyphus-x86_64.tar.xz'
         tarball.touch()
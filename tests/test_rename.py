@@ -1,4 +1,3 @@
-from contextlib import ExitStack
 from pathlib import Path
 from unittest import TestCase
 from unittest import mock
@@ -31,18 +30,15 @@ class TestRename(TestCase):
         os.makedirs(cls.work_dir, exist_ok=True)
         renamer(cls.work_dir)
 
-        with ExitStack() as stack:
-            stack.enter_context(mock.patch('subprocess.call', Call()))
-
-            cloud_build = CB(
-                config='tests/test_rename.yaml',
-                data_dir=(cls.work_dir / 'cloud_build').as_posix(),
-            )
+        with mock.patch('subprocess.call', Call()), CB(
+            config='tests/test_rename.yaml',
+            data_dir=(cls.work_dir / 'cloud_build').as_posix(),
+        ) as cloud_build:
             cloud_build.create_images(no_tests=True)
             cloud_build.sync(create_remote_dirs=True)
 
-        images_dir = cls.work_dir / 'images'
-        cls.images = os.listdir(images_dir)
+        with os.scandir(cls.work_dir / 'images') as it:
+            cls.images = frozenset(entry.name for entry in it)
 
     @classmethod
     def tearDownClass(cls):
@@ -1,22 +1,40 @@
+from pathlib import Path
 from unittest import TestCase
+from unittest import mock
 
+import errno
+import os
 import shutil
 import tempfile
 
+import yaml
+
 from cloud_build import CB
+from cloud_build.cloud_build import (
+    _fast_copy,
+    _load_yaml,
+    _read_yaml_cached,
+    sha256sum,
+)
+from tests import TMP_DIR, YamlDumper, YamlLoader
 
 
 class TestUtils(TestCase):
     def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(
+            prefix='cloud_build',
+            dir=TMP_DIR,
+        )
         kwargs = {
-            'data_dir': tempfile.mkdtemp(prefix='cloud_build'),
+            'data_dir': self.tmp.name,
             'config': 'tests/minimal_config.yaml',
         }
         self.kwargs = kwargs
         self.cb = CB(**kwargs)
 
     def tearDown(self):
-        shutil.rmtree(self.kwargs['data_dir'])
+        self.cb.close()
+        self.tmp.cleanup()
 
     def test_conver_size_lower_case(self):
         self.assertEqual(self.cb.convert_size('200k'), '204800')
@@ -26,3 +44,106 @@ class TestUtils(TestCase):
 
     def test_conver_size_real(self):
         self.assertEqual(self.cb.convert_size('0.1G'), '107374182')
+
+    def test_config_reread_after_change(self):
+        config = tempfile.mktemp(prefix='cb_conf')
+        self.addCleanup(os.unlink, config)
+        with open('tests/minimal_config.yaml') as f:
+            cfg = yaml.load(f, Loader=YamlLoader)
+
+        for remote in ['/var/empty', '/var/empty/changed']:
+            with open(config, 'w') as f:
+                yaml.dump(cfg | {'remote': remote}, f, Dumper=YamlDumper)
+            tmp = tempfile.TemporaryDirectory(
+                prefix='cloud_build',
+                dir=TMP_DIR,
+            )
+            self.addCleanup(tmp.cleanup)
+            with CB(config=config, data_dir=tmp.name) as cb:
+                self.assertEqual(cb._remote, remote)
+
+    def test_copy_external_files_twice(self):
+        external_files = Path(self.kwargs['data_dir'], 'external')
+        os.makedirs(external_files / 'Sisyphus/x86_64')
+        (external_files / 'Sisyphus/x86_64/image.iso').write_text('iso')
+        config = tempfile.mktemp(prefix='cb_conf')
+        self.addCleanup(os.unlink, config)
+        with open('tests/minimal_config.yaml') as f:
+            cfg = yaml.load(f, Loader=YamlLoader)
+        with open(config, 'w') as f:
+            cfg['external_files'] = str(external_files)
+            yaml.dump(cfg, f, Dumper=YamlDumper)
+
+        tmp = tempfile.TemporaryDirectory(prefix='cloud_build', dir=TMP_DIR)
+        self.addCleanup(tmp.cleanup)
+        with CB(config=config, data_dir=tmp.name) as cb:
+            image = cb.images_dir('Sisyphus', 'x86_64') / 'image.iso'
+            cb.copy_external_files()
+            inode = os.stat(image).st_ino
+            with mock.patch('os.unlink', wraps=os.unlink) as unlink:
+                cb.copy_external_files()
+            unlink.assert_not_called()
+            self.assertEqual(os.stat(image).st_ino, inode)
+            self.assertEqual(image.read_text(), 'iso')
+
+    def test_exclude_override(self):
+        image = {
+            'target': 've/docker',
+            'kinds': ['tar.xz'],
+            'exclude_arches': 'x86_64',
+        }
+        override = {'images': {'rootfs-minimal': image}}
+        tmp = tempfile.TemporaryDirectory(prefix='cloud_build', dir=TMP_DIR)
+        self.addCleanup(tmp.cleanup)
+        with CB(
+            config='tests/minimal_config.yaml',
+            data_dir=tmp.name,
+            config_override=override,
+        ) as cb:
+            self.assertTrue(cb.skip_arch('rootfs-minimal', 'x86_64'))
+            self.assertFalse(cb.skip_arch('rootfs-minimal', 'x86'))
+        self.assertEqual(image['exclude_arches'], 'x86_64')
+
+    def test_config_disk_cache(self):
+        config = os.path.join(self.kwargs['data_dir'], 'config.yaml')
+        shutil.copyfile('tests/minimal_config.yaml', config)
+        cache_file = Path(self.kwargs['data_dir'], 'config.cache.json')
+        cfg = _read_yaml_cached(config, cache_file)
+        self.assertTrue(cache_file.exists())
+
+        _load_yaml.cache_clear()
+        with mock.patch('yaml.load') as load:
+            self.assertEqual(_read_yaml_cached(config, cache_file), cfg)
+        load.assert_not_called()
+
+    def test_sha256sum(self):
+        path = os.path.join(self.kwargs['data_dir'], 'a')
+        with open(path, 'w') as f:
+            f.write('a')
+        self.assertEqual(
+            sha256sum([path]),
+            'ca978112ca1bbdcafac231b39a23dc4da786eff8147c4e72b9807785afee48bb'
+            f'  {path}\n',
+        )
+
+    def fast_copy(self, error):
+        src = Path(self.kwargs['data_dir'], 'src')
+        dst = Path(self.kwargs['data_dir'], 'dst')
+        src.write_text('image')
+        with mock.patch('os.link', side_effect=OSError(error, 'link')):
+            _fast_copy(src, dst)
+        self.assertEqual(dst.read_text(), 'image')
+        self.assertFalse(os.path.samefile(src, dst))
+
+    def test_fast_copy_cross_device(self):
+        self.fast_copy(errno.EXDEV)
+
+    def test_fast_copy_fallback_to_copyfile(self):
+        failing = mock.Mock(side_effect=OSError(errno.EXDEV, 'copy'))
+        with mock.patch('fcntl.ioctl', failing), \
+                mock.patch('os.copy_file_range', failing):
+            self.fast_copy(errno.EXDEV)
+
+    def test_fast_copy_existing_destination(self):
+        with self.assertRaises(FileExistsError):
+            self.fast_copy(errno.EEXIST)